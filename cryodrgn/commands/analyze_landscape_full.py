@@ -174,10 +174,6 @@ def generate_and_map_volumes(
     utils.save_pkl(ind, f"{outdir}/ind.sampled.pkl")
     logger.info(f"Saved {outdir}/z.sampled.pkl")
 
-    # Set the device
-    # if torch.cuda.is_available():
-    #     torch.set_default_tensor_type(torch.cuda.FloatTensor)  # type: ignore
-
     cfg = config.update_config_v1(cfg)
     logger.info("Loaded configuration:")
     pprint.pprint(cfg)
@@ -68,6 +68,12 @@ def add_args(parser):
         help="Output voxel sums and counts so that different regularization weights can be applied post hoc, with "
         "`cryodrgn_utils regularize_backproject`.",
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile per-image corrections into fused kernels with torch.compile "
+        "(requires PyTorch 2.0+)",
+    )
 
     group = parser.add_argument_group("Dataset loading options")
     group.add_argument(
@@ -97,6 +103,19 @@ def add_args(parser):
         type=int,
         help="Backproject the first N images (default: all images)",
     )
+    group.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=64,
+        help="Number of images to backproject at a time (default: %(default)s)",
+    )
+    group.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of subprocesses to use as DataLoader workers. If 0, then use the main process for data loading. (default: %(default)s)",
+    )
     group = parser.add_argument_group("Tilt series options")
     group.add_argument(
         "--tilt",
@@ -124,35 +143,75 @@ def add_args(parser):
     )
 
 
+class BackprojectionImages(torch.utils.data.Dataset):
+    """The images to backproject, indexed by image (i.e. by tilt for tilt series)."""
+
+    def __init__(self, data: dataset.ImageDataset, n: int):
+        self.data = data
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        if isinstance(self.data, dataset.TiltSeriesData):
+            return self.data.get_tilt(index)
+        return self.data[index]
+
+
+def flip_and_translate(ff, ctf_sign, tfilt):
+    """Phase flip and then translate a batch of masked Hartley transform images.
+
+    `tfilt` holds the phase shifts 2*pi*k*t of each image (B x N); the value at -k is
+    found by reversing the masked lattice, which is symmetric about the origin.
+    """
+    ff = ff * ctf_sign
+    return torch.cos(tfilt) * ff + torch.sin(tfilt) * ff.flip(-1)
+
+
 def add_slice(volume, counts, ff_coord, ff, D, ctf_mul):
+    """Splat a slice onto the voxels surrounding each of its lattice coordinates.
+
+    Slices are given as a batch of B lattices (`ff_coord` is B x N x 3, `ff` and
+    `ctf_mul` are B x N or broadcastable to it); all eight corners of every slice in the
+    batch are accumulated with a single `index_add_` call on the flattened volume and
+    counts, so that voxels hit more than once are summed correctly.
+    """
     d2 = int(D / 2)
-    ff_coord = ff_coord.transpose(0, 1)
-    xf, yf, zf = ff_coord.floor().long()
-    xc, yc, zc = ff_coord.ceil().long()
-
-    def add_for_corner(xi, yi, zi):
-        dist = torch.stack([xi, yi, zi]).float() - ff_coord
-        w = 1 - dist.pow(2).sum(0).pow(0.5)
-        w[w < 0] = 0
-        volume[(zi + d2, yi + d2, xi + d2)] += w * ff * ctf_mul
-        counts[(zi + d2, yi + d2, xi + d2)] += w * ctf_mul**2
-
-    add_for_corner(xf, yf, zf)
-    add_for_corner(xc, yf, zf)
-    add_for_corner(xf, yc, zf)
-    add_for_corner(xf, yf, zc)
-    add_for_corner(xc, yc, zf)
-    add_for_corner(xf, yc, zc)
-    add_for_corner(xc, yf, zc)
-    add_for_corner(xc, yc, zc)
+
+    # weights and voxel indices at (0) and one above (1) the floor of the slice
+    # coordinates, kept as separate tensors for each of the x, y, and z axes
+    axis_w, axis_idx = [], []
+    for f in ff_coord.unbind(-1):
+        f_floor = f.floor()
+        frac = f - f_floor
+        axis_w.append(torch.stack([1 - frac, frac]))  # 2 x B x N
+        # corners past the edge of the volume only arise with (near-)zero weight
+        i = f_floor.long() + d2
+        axis_idx.append(torch.stack([i, i + 1]).clamp(0, D - 1))  # 2 x B x N
+    wx, wy, wz = axis_w
+    ix, iy, iz = axis_idx
+
+    # trilinear interpolation weights of the eight corners, i.e.
+    # (1 - |dx|) * (1 - |dy|) * (1 - |dz|), as outer products of the axis weights
+    w = (wz[:, None, None] * wy[None, :, None] * wx[None, None, :]).flatten(0, 2)
+    lin_idx = (
+        (iz[:, None, None] * D + iy[None, :, None]) * D + ix[None, None, :]
+    ).view(-1)
+    vals = torch.stack([(w * ff * ctf_mul).view(-1), (w * ctf_mul**2).view(-1)], -1)
+
+    volume.view(-1).index_add_(0, lin_idx, vals[:, 0])
+    counts.view(-1).index_add_(0, lin_idx, vals[:, 1])
 
 
 def regularize_volume(volume, counts, reg_weight):
     regularized_counts = counts + reg_weight * counts.mean()
     regularized_counts *= counts.mean() / regularized_counts.mean()
-    reg_volume = volume / regularized_counts
+    # normalize into the buffer of the counts to only allocate one more full volume
+    reg_volume = torch.div(volume, regularized_counts, out=regularized_counts)
 
-    return fft.ihtn_center(reg_volume[0:-1, 0:-1, 0:-1].cpu())
+    # remove last +k freq for inverse FFT, which we do on the volume's device
+    return fft.ihtn_center(reg_volume[0:-1, 0:-1, 0:-1]).cpu()
 
 
 def main(args):
@@ -169,15 +228,16 @@ def main(args):
     if not use_cuda:
         logger.warning("WARNING: No GPUs detected")
 
-    # load the particles
+    # load the particles; the order in which images are backprojected does not matter,
+    # so we sort the indices to read them from disk in as few contiguous runs as possible
     if args.ind is not None:
         if args.tilt:
             particle_ind = utils.load_pkl(args.ind).astype(int)
             pt, tp = dataset.TiltSeriesData.parse_particle_tilt(args.particles)
             tilt_ind = dataset.TiltSeriesData.particles_to_tilts(pt, particle_ind)
-            args.ind = tilt_ind
+            args.ind = np.sort(tilt_ind)
         else:
-            args.ind = utils.load_pkl(args.ind).astype(int)
+            args.ind = np.sort(utils.load_pkl(args.ind).astype(int))
 
     if args.tilt:
         assert (
@@ -193,7 +253,8 @@ def main(args):
             lazy=args.lazy,
             dose_per_tilt=args.dose_per_tilt,
             angle_per_tilt=args.angle_per_tilt,
-            device=device,
+            # DataLoader workers preprocess tilts on the CPU for pinned-memory copies
+            device=device if args.num_workers == 0 else "cpu",
         )
     else:
         data = dataset.ImageDataset(
@@ -228,78 +289,129 @@ def main(args):
     Apix = float(ctf_params[0, 0]) if ctf_params is not None else 1.0
     voltage = float(ctf_params[0, 4]) if ctf_params is not None else None
     data.voltage = voltage
+
+    # lattice coordinates and frequencies within the mask are the same for every image,
+    # as are the frequencies in 1/A if all images share the same pixel size
     mask = lattice.get_circular_mask(D // 2)
-    iterator = range(min(args.first, Nimg)) if args.first else range(Nimg)
+    # gathering with indices is cheaper than boolean masking for every batch
+    mask_idx = mask.nonzero().squeeze(1)
+    coords_mask = lattice.coords[mask]
+    freqs_mask = lattice.freqs2d[mask]
+    apix_uniform = ctf_params is not None and bool((ctf_params[:, 0] == Apix).all())
+    if apix_uniform:
+        freqs_mask = freqs_mask / Apix
+    trans_freqs = lattice.freqs2d[mask]
+    if args.tilt:
+        tilt_freqs = lattice.freqs2d[mask] / Apix
+        critical_exp = data.critical_exposure(tilt_freqs.pow(2).sum(-1).sqrt())
 
-    volume_full = torch.zeros((D, D, D), device=device)
-    counts_full = torch.zeros((D, D, D), device=device)
-    volume_half1 = torch.zeros((D, D, D), device=device)
-    counts_half1 = torch.zeros((D, D, D), device=device)
-    volume_half2 = torch.zeros((D, D, D), device=device)
-    counts_half2 = torch.zeros((D, D, D), device=device)
+    Nbp = min(args.first, Nimg) if args.first else Nimg
 
-    for ii in iterator:
-        if ii % 100 == 0:
-            logger.info(f"fimage {ii}")
+    # every image goes into exactly one of the half-maps, so when we make them we get
+    # the full map by adding them together instead of backprojecting every image twice
+    if args.half_maps:
+        volume_half1 = torch.zeros((D, D, D), device=device)
+        counts_half1 = torch.zeros((D, D, D), device=device)
+        volume_half2 = torch.zeros((D, D, D), device=device)
+        counts_half2 = torch.zeros((D, D, D), device=device)
+    else:
+        volume_full = torch.zeros((D, D, D), device=device)
+        counts_full = torch.zeros((D, D, D), device=device)
+
+    correct_images = flip_and_translate
+    if args.compile:
+        correct_images = torch.compile(flip_and_translate, dynamic=True)
+
+    num_workers = min(args.num_workers, os.cpu_count() or 1)
+    data_generator = dataset.make_dataloader(
+        BackprojectionImages(data, Nbp),
+        batch_size=args.batch_size,
+        num_workers=num_workers,
+        shuffle=False,
+        pin_memory=use_cuda and torch.device(data.device).type == "cpu",
+    )
 
-        r, t = posetracker.get_pose(ii)
-        ff = data.get_tilt(ii) if args.tilt else data[ii]
-        assert isinstance(ff, tuple)
+    for minibatch in data_generator:
+        logger.info(f"fimage {int(minibatch[-1][0])}")
+        ind = minibatch[-1].to(device)
+        B = len(ind)
 
-        ff = ff[0].to(device)
-        ff = ff.view(-1)[mask]
-        ctf_mul = 1
+        r, t = posetracker.get_pose(ind)
+        ff = minibatch[0].to(device, non_blocking=True)
+        ff = ff.view(B, -1).index_select(1, mask_idx)
+        ctf_mul = torch.ones((B, 1), device=device)
+        ctf_sign = 1
 
         if ctf_params is not None:
-            freqs = lattice.freqs2d / ctf_params[ii, 0]
-            c = ctf.compute_ctf(freqs, *ctf_params[ii, 1:]).view(-1)[mask]
+            if apix_uniform:
+                freqs = freqs_mask
+            else:
+                freqs = freqs_mask / ctf_params[ind, 0].view(B, 1, 1)
+            c = ctf.compute_ctf(freqs, *torch.split(ctf_params[ind, 1:], 1, 1))
 
             if args.ctf_alg == "flip":
-                ff *= c.sign()
+                ctf_sign = c.sign()
             else:
                 ctf_mul = c
 
         if t is not None:
-            ff = lattice.translate_ht(ff.view(1, -1), t.view(1, 1, 2), mask).view(-1)
+            tfilt = (trans_freqs @ t.view(B, 2, 1)).view(B, -1) * 2 * np.pi
+            ff = correct_images(ff, ctf_sign, tfilt)
+        else:
+            ff = ff * ctf_sign
 
         if args.tilt:
-            tilt_idxs = torch.tensor([ii]).to(device)
-            dose_filters = data.get_dose_filters(tilt_idxs, lattice, ctf_params[ii, 0])[
-                0
-            ]
-            ctf_mul *= dose_filters[mask]
-
-        ff_coord = lattice.coords[mask] @ r
-        add_slice(volume_full, counts_full, ff_coord, ff, D, ctf_mul)
+            exposure_filters = data.get_exposure_filters(ind, critical_exp)
+            ctf_mul = ctf_mul * exposure_filters.to(device)
 
+        ff_coord = coords_mask @ r
         if args.half_maps:
-            if ii % 2 == 0:
-                add_slice(volume_half1, counts_half1, ff_coord, ff, D, ctf_mul)
-            else:
-                add_slice(volume_half2, counts_half2, ff_coord, ff, D, ctf_mul)
+            # split the batch using the indices on the host to avoid a device sync
+            half1 = (minibatch[-1] % 2 == 0).nonzero().squeeze(1).to(device)
+            half2 = (minibatch[-1] % 2 == 1).nonzero().squeeze(1).to(device)
+            add_slice(
+                volume_half1,
+                counts_half1,
+                ff_coord.index_select(0, half1),
+                ff.index_select(0, half1),
+                D,
+                ctf_mul.index_select(0, half1),
+            )
+            add_slice(
+                volume_half2,
+                counts_half2,
+                ff_coord.index_select(0, half2),
+                ff.index_select(0, half2),
+                D,
+                ctf_mul.index_select(0, half2),
+            )
+        else:
+            add_slice(volume_full, counts_full, ff_coord, ff, D, ctf_mul)
 
     td = time.time() - t1
-    logger.info(
-        f"Backprojected {len(iterator)} images "
-        f"in {td:.2f}s ({(td / Nimg):4f}s per image)"
-    )
+    logger.info(f"Backprojected {Nbp} images in {td:.2f}s ({(td / Nbp):4f}s per image)")
 
+    if args.half_maps:
+        volume_full = volume_half1 + volume_half2
+        counts_full = counts_half1 + counts_half2
+        counts_half1[counts_half1 == 0] = 1
+        counts_half2[counts_half2 == 0] = 1
     counts_full[counts_full == 0] = 1
-    counts_half1[counts_half1 == 0] = 1
-    counts_half2[counts_half2 == 0] = 1
 
     if args.output_sumcount:
         MRCFile.write(args.o + ".sums", volume_full.cpu().numpy(), Apix=Apix)
         MRCFile.write(args.o + ".counts", counts_full.cpu().numpy(), Apix=Apix)
 
     volume_full = regularize_volume(volume_full, counts_full, args.reg_weight)
+    del counts_full  # release the full map's counts before regularizing the halves
     out_path = os.path.splitext(args.o)[0]
     MRCFile.write(args.o, np.array(volume_full).astype("float32"), Apix=Apix)
 
     if args.half_maps:
         volume_half1 = regularize_volume(volume_half1, counts_half1, args.reg_weight)
         volume_half2 = regularize_volume(volume_half2, counts_half2, args.reg_weight)
-        fsc_vals = calculate_fsc(volume_half1, volume_half2)
+        fsc_vals = calculate_fsc(volume_half1, volume_half2).set_index("pixres")
+        fsc_vals = fsc_vals["fsc"]
 
         fsc_vals.to_csv("_".join([out_path, "fsc-vals.txt"]), sep=" ", header=False)
         plt.plot(fsc_vals.index, fsc_vals.values)
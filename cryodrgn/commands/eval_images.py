@@ -225,6 +225,10 @@ def eval_batch(
     loss, gen_loss, kld = loss_function(
         z_mu, z_logvar, y, ntilts, y_recon, mask, beta, beta_control=None
     )
+    if torch.isnan(kld):
+        logger.info(z_mu[0])
+        logger.info(z_logvar[0])
+        raise RuntimeError("KLD is nan")
     return (
         z_mu.detach().cpu().numpy(),
         z_logvar.detach().cpu().numpy(),
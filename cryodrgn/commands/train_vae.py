@@ -2,6 +2,7 @@
 Train a VAE for heterogeneous reconstruction with known pose
 """
 import argparse
+import contextlib
 import os
 import pickle
 import sys
@@ -14,11 +15,6 @@ import torch.nn as nn
 from torch.nn.parallel import DataParallel
 import torch.nn.functional as F
 
-try:
-    import apex.amp as amp  # type: ignore  # PYR01
-except ImportError:
-    pass
-
 import cryodrgn
 from cryodrgn import __version__, ctf, dataset
 from cryodrgn.beta_schedule import get_beta_schedule
@@ -65,7 +61,8 @@ def add_args(parser: argparse.ArgumentParser):
         "--log-interval",
         type=int,
         default=1000,
-        help="Logging interval in N_IMGS (default: %(default)s)",
+        help="Logging interval in N_IMGS; training stops on a nan KLD at the first "
+        "logging step after it occurs (default: %(default)s)",
     )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Increase verbosity"
@@ -227,6 +224,18 @@ def add_args(parser: argparse.ArgumentParser):
         action="store_true",
         help="Parallelize training across all detected GPUs",
     )
+    group.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the encoder, decoder and losses into fused kernels with torch.compile "
+        "(requires PyTorch 2.2+)",
+    )
+    group.add_argument(
+        "--cuda-graphs",
+        action="store_true",
+        help="Experimental: replay the compiled encoder, decoder and losses as CUDA "
+        "graphs to reduce kernel launch overhead (implies --compile)",
+    )
 
     group = parser.add_argument_group("Pose SGD")
     group.add_argument(
@@ -338,6 +347,15 @@ def add_args(parser: argparse.ArgumentParser):
     return parser
 
 
+def vae_losses(y_recon, y, z_mu, z_logvar):
+    """Reconstruction error and KL divergence of a batch, fused if compiled"""
+    gen_loss = F.mse_loss(y_recon, y)
+    kld = torch.mean(
+        -0.5 * torch.sum(1 + z_logvar - z_mu.pow(2) - z_logvar.exp(), dim=1), dim=0
+    )
+    return gen_loss, kld
+
+
 def train_batch(
     model: nn.Module,
     lattice: Lattice,
@@ -353,49 +371,61 @@ def train_batch(
     use_amp: bool = False,
     scaler=None,
     dose_filters=None,
+    loss_fn=vae_losses,
 ):
     optim.zero_grad()
     model.train()
     if trans is not None:
         y = preprocess_input(y, lattice, trans)
-    # Cast operations to mixed precision if using torch.cuda.amp.GradScaler()
-    if scaler is not None:
-        with torch.cuda.amp.autocast_mode.autocast():
-            z_mu, z_logvar, z, y_recon, mask = run_batch(
-                model, lattice, y, rot, ntilts, ctf_params, yr
-            )
-            loss, gen_loss, kld = loss_function(
-                z_mu,
-                z_logvar,
-                y,
-                ntilts,
-                y_recon,
-                mask,
-                beta,
-                beta_control,
-                dose_filters,
-            )
+    # Cast operations to mixed precision if using torch.amp.GradScaler() on the GPU
+    if use_amp and scaler.is_enabled():
+        autocast = torch.amp.autocast("cuda")
     else:
-        # print('AAA', y.shape, rot.shape)
+        autocast = contextlib.nullcontext()
+    with autocast:
         z_mu, z_logvar, z, y_recon, mask = run_batch(
             model, lattice, y, rot, ntilts, ctf_params, yr
         )
         loss, gen_loss, kld = loss_function(
-            z_mu, z_logvar, y, ntilts, y_recon, mask, beta, beta_control, dose_filters
+            z_mu,
+            z_logvar,
+            y,
+            ntilts,
+            y_recon,
+            mask,
+            beta,
+            beta_control,
+            dose_filters,
+            loss_fn,
         )
     if use_amp:
-        if scaler is not None:  # torch mixed precision
-            scaler.scale(loss).backward()
-            scaler.step(optim)
-            scaler.update()
-        else:  # apex.amp mixed precision
-            with amp.scale_loss(loss, optim) as scaled_loss:
-                scaled_loss.backward()
-            optim.step()
+        scaler.scale(loss).backward()
+        scaler.step(optim)
+        scaler.update()
     else:
         loss.backward()
         optim.step()
-    return loss.item(), gen_loss.item(), kld.item()
+    # the latents of the first image are returned for reporting a nan KLD; they are
+    # copied as outputs of an encoder replayed with CUDA graphs are overwritten
+    return (
+        loss.detach(),
+        gen_loss.detach(),
+        kld.detach(),
+        z_mu[0].detach().clone(),
+        z_logvar[0].detach().clone(),
+    )
+
+
+def check_kld(kld_accum, z_mu, z_logvar):
+    """Stop training if the KLD accumulated since the start of the epoch is nan.
+
+    This is only checked when logging to avoid a device sync on every batch, so the
+    latents of the first image in the latest batch are logged as diagnostics.
+    """
+    if torch.isnan(kld_accum):
+        logger.info(z_mu)
+        logger.info(z_logvar)
+        raise RuntimeError("KLD is nan")
 
 
 def preprocess_input(y, lattice, trans):
@@ -450,28 +480,21 @@ def loss_function(
     beta: float,
     beta_control=None,
     dose_filters=None,
+    loss_fn=vae_losses,
 ):
-    # reconstruction error
     B = y.size(0)
     y = y.view(B, -1)[:, mask]
     if dose_filters is not None:
         y_recon = torch.mul(y_recon, dose_filters[:, mask])
-    gen_loss = F.mse_loss(y_recon, y)
 
-    # latent loss
-    kld = torch.mean(
-        -0.5 * torch.sum(1 + z_logvar - z_mu.pow(2) - z_logvar.exp(), dim=1), dim=0
-    )
-    if torch.isnan(kld):
-        logger.info(z_mu[0])
-        logger.info(z_logvar[0])
-        raise RuntimeError("KLD is nan")
+    # reconstruction error and latent loss
+    gen_loss, kld = loss_fn(y_recon, y, z_mu, z_logvar)
 
     # total loss
     if beta_control is None:
         loss = gen_loss + beta * kld / mask.sum().float()
     else:
-        loss = gen_loss + args.beta_control * (beta - kld) ** 2 / mask.sum().float()
+        loss = gen_loss + beta_control * (beta - kld) ** 2 / mask.sum().float()
     return loss, gen_loss, kld
 
 
@@ -486,17 +509,25 @@ def eval_z(
     ctf_params=None,
     use_real=False,
     shuffler_size=0,
+    num_workers=0,
+    pin_memory=False,
+    cuda_graphs=False,
 ):
     logger.info("Evaluating z")
     assert not model.training
     z_mu_all = []
     z_logvar_all = []
     data_generator = dataset.make_dataloader(
-        data, batch_size=batch_size, shuffler_size=shuffler_size, shuffle=False
+        data,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffler_size=shuffler_size,
+        shuffle=False,
+        pin_memory=pin_memory,
     )
     for i, minibatch in enumerate(data_generator):
-        ind = minibatch[-1]
-        y = minibatch[0].to(device)
+        ind = minibatch[-1].to(device)
+        y = minibatch[0].to(device, non_blocking=True)
         D = lattice.D
         if use_tilt:
             y = y.view(-1, D, D)
@@ -517,7 +548,8 @@ def eval_z(
             )
 
         if use_real:
-            input_ = (torch.from_numpy(data.particles_real[ind]).to(device),)
+            ind_np = minibatch[-1].numpy()
+            input_ = (torch.from_numpy(data.particles_real[ind_np]).to(device),)
         else:
             input_ = (y,)
         if c is not None:
@@ -525,11 +557,16 @@ def eval_z(
             input_ = (x * c.sign() for x in input_)  # phase flip by the ctf
         _model = unparallelize(model)
         assert isinstance(_model, HetOnlyVAE)
+        if cuda_graphs:
+            torch.compiler.cudagraph_mark_step_begin()
         z_mu, z_logvar = _model.encode(*input_)
-        z_mu_all.append(z_mu.detach().cpu().numpy())
-        z_logvar_all.append(z_logvar.detach().cpu().numpy())
-    z_mu_all = np.vstack(z_mu_all)
-    z_logvar_all = np.vstack(z_logvar_all)
+        # copy the latents, as outputs of an encoder replayed with CUDA graphs are
+        # overwritten by the next batch
+        z_mu_all.append(z_mu.detach().clone())
+        z_logvar_all.append(z_logvar.detach().clone())
+    # copy the latents to the host once rather than once per batch
+    z_mu_all = torch.cat(z_mu_all).cpu().numpy()
+    z_logvar_all = torch.cat(z_logvar_all).cpu().numpy()
     return z_mu_all, z_logvar_all
 
 
@@ -675,7 +712,9 @@ def main(args):
             datadir=args.datadir,
             window_r=args.window_r,
             max_threads=args.max_threads,
-            device=device,
+            # DataLoader workers preprocess images on the CPU for pinned-memory copies;
+            # the data shuffler always loads batches in the main process
+            device=device if args.num_workers == 0 or args.shuffler_size > 0 else "cpu",
         )
     else:
         assert args.encode_mode == "tilt"
@@ -778,6 +817,14 @@ def main(args):
     )
     model.to(device)
     logger.info(model)
+    loss_fn = vae_losses
+    if args.compile or args.cuda_graphs:
+        # torch.compile records and replays CUDA graphs in its reduce-overhead mode
+        mode = "reduce-overhead" if args.cuda_graphs else None
+        # compile in place so that the keys of saved state dicts are unchanged
+        model.encoder.compile(dynamic=False, mode=mode)
+        model.decoder.compile(dynamic=False, mode=mode)
+        loss_fn = torch.compile(vae_losses, dynamic=False, mode=mode)
     logger.info(
         "{} parameters in model".format(
             sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -824,11 +871,8 @@ def main(args):
             logger.warning(
                 "Warning: Masked input image dimension is not a mutiple of 8 -- AMP training speedup is not optimized"
             )
-        try:  # Mixed precision with apex.amp
-            model, optim = amp.initialize(model, optim, opt_level="O1")
-        except:  # noqa: E722
-            # Mixed precision with pytorch (v1.6+)
-            scaler = torch.cuda.amp.grad_scaler.GradScaler()
+        # Mixed precision with pytorch, which only casts and scales on the GPU
+        scaler = torch.amp.GradScaler("cuda", enabled=use_cuda)
 
     # restart from checkpoint
     if args.load:
@@ -858,12 +902,19 @@ def main(args):
         logger.warning(f"Reducing workers to {cpu_count} cpus")
         num_workers = cpu_count
 
+    # only use workers for evaluating z when images are not preprocessed on the GPU
+    data_on_cpu = torch.device(data.device).type == "cpu"
+    eval_workers = num_workers if data_on_cpu else 0
+    pin_memory = use_cuda and data_on_cpu
+
     # training loop
     data_generator = dataset.make_dataloader(
         data,
         batch_size=args.batch_size,
         num_workers=num_workers,
         shuffler_size=args.shuffler_size,
+        pin_memory=pin_memory,
+        persistent_workers=True,
     )
 
     num_epochs = args.num_epochs
@@ -871,13 +922,14 @@ def main(args):
     Nparticles = Nimg if args.encode_mode != "tilt" else data.Np
     for epoch in range(start_epoch, num_epochs):
         t2 = dt.now()
-        gen_loss_accum = 0
-        loss_accum = 0
-        kld_accum = 0
+        # accumulate losses on the device so that they are only synced when logged
+        gen_loss_accum = torch.zeros((), device=device)
+        loss_accum = torch.zeros((), device=device)
+        kld_accum = torch.zeros((), device=device)
         batch_it = 0
         for i, minibatch in enumerate(data_generator):  # minibatch: [y, ind]
-            ind = minibatch[-1].to(device)
-            y = minibatch[0].to(device)
+            ind = minibatch[-1].to(device, non_blocking=True)
+            y = minibatch[0].to(device, non_blocking=True)
             B = len(ind)
             batch_it += B
             global_it = Nparticles * epoch + batch_it
@@ -887,14 +939,14 @@ def main(args):
             yr = None
             if args.use_real:
                 assert hasattr(data, "particles_real")
-                yr = torch.from_numpy(data.particles_real[ind.numpy()]).to(device)  # type: ignore  # PYR02
+                yr = torch.from_numpy(data.particles_real[minibatch[-1].numpy()]).to(device)  # type: ignore  # PYR02
             if pose_optimizer is not None:
                 pose_optimizer.zero_grad()
 
             dose_filters = None
             if args.encode_mode == "tilt":
-                tilt_ind = minibatch[1].to(device)
-                assert all(tilt_ind >= 0), tilt_ind
+                tilt_ind = minibatch[1].to(device, non_blocking=True)
+                assert (tilt_ind >= 0).all(), tilt_ind
                 rot, tran = posetracker.get_pose(tilt_ind.view(-1))
                 ctf_param = (
                     ctf_params[tilt_ind.view(-1)] if ctf_params is not None else None
@@ -907,7 +959,10 @@ def main(args):
                 rot, tran = posetracker.get_pose(ind)
                 ctf_param = ctf_params[ind] if ctf_params is not None else None
 
-            loss, gen_loss, kld = train_batch(
+            if args.cuda_graphs:
+                # outputs of the graphs replayed in the previous step are no longer used
+                torch.compiler.cudagraph_mark_step_begin()
+            loss, gen_loss, kld, z_mu, z_logvar = train_batch(
                 model,
                 lattice,
                 y,
@@ -922,6 +977,7 @@ def main(args):
                 use_amp=args.amp,
                 scaler=scaler,
                 dose_filters=dose_filters,
+                loss_fn=loss_fn,
             )
             if pose_optimizer is not None and epoch >= args.pretrain:
                 pose_optimizer.step()
@@ -932,6 +988,7 @@ def main(args):
             loss_accum += loss * B
 
             if batch_it % args.log_interval == 0:
+                check_kld(kld_accum, z_mu, z_logvar)
                 logger.info(
                     "# [Train Epoch: {}/{}] [{}/{} particles] gen loss={:.6f}, kld={:.6f}, beta={:.6f}, "
                     "loss={:.6f}".format(
@@ -939,18 +996,19 @@ def main(args):
                         num_epochs,
                         batch_it,
                         Nparticles,
-                        gen_loss,
-                        kld,
+                        gen_loss.item(),
+                        kld.item(),
                         beta,
-                        loss,
+                        loss.item(),
                     )
                 )
+        check_kld(kld_accum, z_mu, z_logvar)
         logger.info(
             "# =====> Epoch: {} Average gen loss = {:.6}, KLD = {:.6f}, total loss = {:.6f}; Finished in {}".format(
                 epoch + 1,
-                gen_loss_accum / Nparticles,
-                kld_accum / Nparticles,
-                loss_accum / Nparticles,
+                gen_loss_accum.item() / Nparticles,
+                kld_accum.item() / Nparticles,
+                loss_accum.item() / Nparticles,
                 dt.now() - t2,
             )
         )
@@ -971,6 +1029,9 @@ def main(args):
                     ctf_params=ctf_params,
                     use_real=args.use_real,
                     shuffler_size=args.shuffler_size,
+                    num_workers=eval_workers,
+                    pin_memory=pin_memory,
+                    cuda_graphs=args.cuda_graphs,
                 )
                 save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z)
             if args.do_pose_sgd and epoch >= args.pretrain:
@@ -993,6 +1054,9 @@ def main(args):
             args.encode_mode == "tilt",
             ctf_params,
             args.use_real,
+            num_workers=eval_workers,
+            pin_memory=pin_memory,
+            cuda_graphs=args.cuda_graphs,
         )
         save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z)
 
@@ -88,7 +88,7 @@ def compute_ctf(
     cs = cs * 10**7
     dfang = dfang * np.pi / 180
     if phase_shift is None:
-        phase_shift = torch.tensor(0)
+        phase_shift = torch.zeros_like(dfu)
     phase_shift = phase_shift * np.pi / 180
 
     # lam = sqrt(h^2/(2*m*e*Vr)); Vr = V + (e/(2*m*c^2))*V^2
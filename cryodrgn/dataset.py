@@ -266,30 +266,33 @@ class TiltSeriesData(ImageDataset):
         return torch.add(critical_exp, 2.81)
 
     def get_dose_filters(self, tilt_index, lattice, Apix):
-        D = lattice.D
-
-        N = len(tilt_index)
         freqs = lattice.freqs2d / Apix  # D/A
         x = freqs[..., 0]
         y = freqs[..., 1]
         s2 = x**2 + y**2
         s = torch.sqrt(s2)
 
-        cumulative_dose = self.tilt_numbers[tilt_index] * self.dose_per_tilt
-        cd_tile = torch.repeat_interleave(cumulative_dose, D * D).view(N, -1)
+        return self.get_exposure_filters(tilt_index, self.critical_exposure(s))
+
+    def get_exposure_filters(self, tilt_index, critical_exp):
+        """Dose and tilt angle weights of the given tilts at each frequency.
 
-        ce = self.critical_exposure(s).to(self.device)
-        ce_tile = ce.repeat(N, 1)
+        The critical exposure only depends on the frequencies, and can thus be computed
+        once by the caller and reused across batches of tilts.
+        """
+        tilt_index = torch.as_tensor(tilt_index, device=self.device).view(-1)
+        critical_exp = critical_exp.to(self.device)
+        cumulative_dose = self.tilt_numbers[tilt_index] * self.dose_per_tilt
+        cumulative_dose = cumulative_dose.view(-1, 1)
 
-        oe_tile = ce_tile * 2.51284  # Optimal exposure
-        oe_mask = (cd_tile < oe_tile).long()
+        optimal_exp = critical_exp * 2.51284
+        oe_mask = (cumulative_dose < optimal_exp).long()
 
-        freq_correction = torch.exp(-0.5 * cd_tile / ce_tile)
+        freq_correction = torch.exp(-0.5 * cumulative_dose / critical_exp)
         freq_correction = torch.mul(freq_correction, oe_mask)
         angle_correction = torch.cos(self.tilt_angles[tilt_index] * np.pi / 180)
-        ac_tile = torch.repeat_interleave(angle_correction, D * D).view(N, -1)
 
-        return torch.mul(freq_correction, ac_tile).float()
+        return torch.mul(freq_correction, angle_correction.view(-1, 1)).float()
 
     def optimal_exposure(self, freq):
         return 2.51284 * self.critical_exposure(freq)
@@ -453,6 +456,8 @@ def make_dataloader(
     num_workers: int = 0,
     shuffler_size: int = 0,
     shuffle=True,
+    pin_memory: bool = False,
+    persistent_workers: bool = False,
 ):
     if shuffler_size > 0 and shuffle:
         assert data.lazy, "Only enable a data shuffler for lazy loading"
@@ -461,6 +466,13 @@ def make_dataloader(
         # see https://github.com/zhonge/cryodrgn/pull/221#discussion_r1120711123
         # for discussion of why we use BatchSampler, etc.
         sampler_cls = RandomSampler if shuffle else SequentialSampler
+        # each worker loads batches ahead of time; loaders iterated over for many
+        # epochs can also keep their worker processes alive between epochs
+        worker_kwargs = (
+            dict(persistent_workers=persistent_workers, prefetch_factor=4)
+            if num_workers > 0
+            else {}
+        )
         return DataLoader(
             data,
             num_workers=num_workers,
@@ -469,4 +481,6 @@ def make_dataloader(
             ),
             batch_size=None,
             multiprocessing_context="spawn" if num_workers > 0 else None,
+            pin_memory=pin_memory,
+            **worker_kwargs,
         )
@@ -22,6 +22,29 @@ def unparallelize(model: nn.Module) -> nn.Module:
     return model
 
 
+def zslice_batches(coords: Tensor, D: int, extent: float, max_points: int = 2**18):
+    """
+    Iterate over the z-slices of a DxDxD lattice in batches of slices
+
+    Inputs:
+        coords: lattice coords on the x-y plane (D^2 x 3)
+        D: size of lattice
+        extent: extent of lattice [-extent, extent]
+        max_points: maximum number of lattice points in a batch of slices
+
+    Yields the index of the first slice in the batch, the z-values of the
+    slices (n), and the lattice coords of the slices (n x D^2 x 3)
+    """
+    dzs = torch.tensor(
+        np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32),
+        device=coords.device,
+    )
+    n = max(1, max_points // coords.shape[0])
+    for i in range(0, D, n):
+        dz = dzs[i : i + n]
+        yield i, dz, coords + F.pad(dz.view(-1, 1, 1), (2, 0))
+
+
 class HetOnlyVAE(nn.Module):
     # No pose inference
     def __init__(
@@ -395,17 +418,14 @@ class PositionalDecoder(Decoder):
 
         vol_f = torch.zeros((D, D, D), dtype=torch.float32)
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
-        ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
+        # evaluate the volume in batches of zslices to avoid memory overflows
+        for i, _, x in zslice_batches(coords, D, extent):
             if zval is not None:
-                x = torch.cat((x, z.expand(x.shape[0], zdim)), dim=-1)
+                x = torch.cat((x, z.expand(*x.shape[:-1], zdim)), dim=-1)
             with torch.no_grad():
                 y = self.forward(x)
-                y = y.view(D, D)
-            vol_f[i] = y
+                y = y.view(-1, D, D)
+            vol_f[i : i + len(y)] = y
         vol_f = vol_f * norm[1] + norm[0]
         vol = fft.ihtn_center(
             vol_f[0:-1, 0:-1, 0:-1]
@@ -541,23 +561,24 @@ class FTPositionalDecoder(Decoder):
         top_half = self.decode(lattice[..., 0:cc, :])
         image[..., 0:cc] = top_half[..., 0] - top_half[..., 1]
         # the bottom half of the image is the complex conjugate of the top half
-        image[..., cc:] = (top_half[..., 0] + top_half[..., 1])[
-            ..., np.arange(c - 1, -1, -1)
-        ]
+        image[..., cc:] = (top_half[..., 0:c, 0] + top_half[..., 0:c, 1]).flip(-1)
         return image
 
     def decode(self, lattice: Tensor):
         """Return FT transform"""
         assert (lattice[..., 0:3].abs() - 0.5 < 1e-4).all()
         # convention: only evalute the -z points
-        w = lattice[..., 2] > 0.0
-        new_lattice = lattice.clone()
+        w = lattice[..., 2:3] > 0.0
         # negate lattice coordinates where z > 0
-        new_lattice[..., 0:3][w] *= -1
+        new_lattice = torch.cat(
+            (torch.where(w, -lattice[..., 0:3], lattice[..., 0:3]), lattice[..., 3:]),
+            -1,
+        )
         result = self.decoder(self.positional_encoding_geom(new_lattice))
         # replace with complex conjugate to get correct values for original lattice positions
-        result[..., 1][w] *= -1
-        return result
+        return torch.cat(
+            (result[..., 0:1], torch.where(w, -result[..., 1:2], result[..., 1:2])), -1
+        )
 
     def eval_volume(
         self,
@@ -586,25 +607,19 @@ class FTPositionalDecoder(Decoder):
 
         vol_f = torch.zeros((D, D, D), dtype=torch.float32)
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
-        ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
-            keep = x.pow(2).sum(dim=1) <= extent**2
-            x = x[keep]
+        # evaluate the volume in batches of zslices to avoid memory overflows
+        for i, dz, x in zslice_batches(coords, D, extent):
+            keep = x.pow(2).sum(dim=-1) <= extent**2
             if zval is not None:
-                x = torch.cat((x, z.expand(x.shape[0], zdim)), dim=-1)
+                x = torch.cat((x, z.expand(*x.shape[:-1], zdim)), dim=-1)
             with torch.no_grad():
-                if dz == 0.0:
-                    y = self.forward(x)
-                else:
-                    y = self.decode(x)
-                    y = y[..., 0] - y[..., 1]
-                slice_ = torch.zeros(D**2, device="cpu")
-                slice_[keep] = y.cpu()
-                slice_ = slice_.view(D, D)
-            vol_f[i] = slice_
+                y = self.decode(x[keep])
+                slices = torch.zeros(keep.shape, device="cpu")
+                slices[keep.cpu()] = (y[..., 0] - y[..., 1]).cpu()
+                # the central slice is made exactly conjugate symmetric
+                for j in (dz == 0.0).nonzero().flatten().tolist():
+                    slices[j, keep[j].cpu()] = self.forward(x[j][keep[j]]).cpu()
+            vol_f[i : i + len(slices)] = slices.view(-1, D, D)
         vol_f = vol_f * norm[1] + norm[0]
         vol = fft.ihtn_center(
             vol_f[:-1, :-1, :-1]
@@ -669,9 +684,7 @@ class FTSliceDecoder(Decoder):
         top_half = self.decode(lattice[..., 0 : c + 1, :])
         image[..., 0 : c + 1] = top_half[..., 0] - top_half[..., 1]
         # the bottom half of the image is the complex conjugate of the top half
-        image[..., c + 1 :] = (top_half[..., 0] + top_half[..., 1])[
-            ..., np.arange(c - 1, -1, -1)
-        ]
+        image[..., c + 1 :] = (top_half[..., 0:c, 0] + top_half[..., 0:c, 1]).flip(-1)
         return image
 
     def forward_even(self, lattice):
@@ -688,15 +701,17 @@ class FTSliceDecoder(Decoder):
     def decode(self, lattice):
         """Return FT transform"""
         # convention: only evalute the -z points
-        w = lattice[..., 2] > 0.0
-        new_lattice = lattice.clone()
+        w = lattice[..., 2:3] > 0.0
         # negate lattice coordinates where z > 0
-
-        new_lattice[..., 0:3][w] *= -1
+        new_lattice = torch.cat(
+            (torch.where(w, -lattice[..., 0:3], lattice[..., 0:3]), lattice[..., 3:]),
+            -1,
+        )
         result = self.decoder(new_lattice)
         # replace with complex conjugate to get correct values for original lattice positions
-        result[..., 1][w] *= -1
-        return result
+        return torch.cat(
+            (result[..., 0:1], torch.where(w, -result[..., 1:2], result[..., 1:2])), -1
+        )
 
     def eval_volume(
         self,
@@ -718,26 +733,22 @@ class FTSliceDecoder(Decoder):
         """
         if zval is not None:
             zdim = len(zval)
-            z = torch.zeros(D**2, zdim, dtype=torch.float32)
-            z += torch.tensor(zval, dtype=torch.float32, device=coords.device)
+            z = torch.tensor(zval, dtype=torch.float32, device=coords.device)
         else:
             z = None
 
         vol_f = torch.zeros((D, D, D), dtype=torch.float32)
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
-        ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
+        # evaluate the volume in batches of zslices to avoid memory overflows
+        for i, _, x in zslice_batches(coords, D, extent):
             if zval is not None:
                 assert z is not None
-                x = torch.cat((x, z), dim=-1)
+                x = torch.cat((x, z.expand(*x.shape[:-1], zdim)), dim=-1)
             with torch.no_grad():
                 y = self.decode(x)
                 y = y[..., 0] - y[..., 1]
-                y = y.view(D, D).cpu()
-            vol_f[i] = y
+                y = y.view(-1, D, D).cpu()
+            vol_f[i : i + len(y)] = y
         vol_f = vol_f * norm[1] + norm[0]
         vol_f = utils.zero_sphere(vol_f)
         vol = fft.ihtn_center(
@@ -1027,22 +1038,18 @@ class ResidLinearMLP(Decoder):
         # volume is generated
         if zval is not None:
             zdim = len(zval)
-            z = torch.zeros(D**2, zdim, dtype=torch.float32, device=coords.device)
-            z += torch.tensor(zval, dtype=torch.float32, device=coords.device)
+            z = torch.tensor(zval, dtype=torch.float32, device=coords.device)
 
         vol_f = torch.zeros((D, D, D), dtype=torch.float32)
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
-        ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
+        # evaluate the volume in batches of zslices to avoid memory overflows
+        for i, _, x in zslice_batches(coords, D, extent):
             if zval is not None:
-                x = torch.cat((x, zval), dim=-1)
+                x = torch.cat((x, z.expand(*x.shape[:-1], zdim)), dim=-1)
             with torch.no_grad():
                 y = self.forward(x)
-                y = y.view(D, D).cpu()
-            vol_f[i] = y
+                y = y.view(-1, D, D).cpu()
+            vol_f[i : i + len(y)] = y
         vol_f = vol_f * norm[1] + norm[0]
         vol = fft.ihtn_center(
             vol_f[0:-1, 0:-1, 0:-1]
@@ -286,24 +286,18 @@ class MRCFileSource(ImageSource):
             if require_contiguous:
                 assert is_contiguous, "MRC indices are not contiguous."
 
-            if is_contiguous:
+            # read each run of consecutive indices with a single call
+            runs = np.flatnonzero(np.diff(indices) != 1) + 1
+            for run, tgt_run in zip(
+                np.split(indices, runs), np.split(tgt_indices, runs)
+            ):
                 f.seek(self.start)
-                offset = indices[0] * self.stride
+                offset = run[0] * self.stride
                 # 'offset' in the call below is w.r.t the current position of f
                 _data = np.fromfile(
-                    f, dtype=self.dtype, count=self.size * len(indices), offset=offset
+                    f, dtype=self.dtype, count=self.size * len(run), offset=offset
                 ).reshape(-1, self.ny, self.nx)
-                data[tgt_indices, ...] = _data
-
-            else:
-                for index, tgt_index in zip(indices, tgt_indices):
-                    f.seek(self.start)
-                    offset = index * self.stride
-                    # 'offset' in the call below is w.r.t the current position of f
-                    _data = np.fromfile(
-                        f, dtype=self.dtype, count=self.size, offset=offset
-                    ).reshape(self.ny, self.nx)
-                    data[tgt_index, ...] = _data
+                data[tgt_run, ...] = _data
 
             return data
 
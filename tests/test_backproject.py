@@ -0,0 +1,104 @@
+import argparse
+import os.path
+import pickle
+import numpy as np
+import pytest
+import torch
+from cryodrgn.commands import backproject_voxel
+from cryodrgn.commands.backproject_voxel import add_slice
+from cryodrgn.mrc import MRCFile
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
+
+
+@pytest.mark.parametrize("D", [9, 33])
+def test_add_slice_accumulates_repeated_voxels(D):
+    d2 = D // 2
+    ff_coord = torch.tensor([[0.25, -1.5, 2.0]]).repeat(4, 1)
+    ff = torch.tensor([1.0, 2.0, 3.0, 4.0])
+
+    volume = torch.zeros((D, D, D))
+    counts = torch.zeros((D, D, D))
+    add_slice(volume, counts, ff_coord, ff, D, 1)
+
+    single_vol = torch.zeros((D, D, D))
+    single_counts = torch.zeros((D, D, D))
+    add_slice(single_vol, single_counts, ff_coord[:1], ff[:1], D, 1)
+
+    assert torch.allclose(volume, single_vol * ff.sum())
+    assert torch.allclose(counts, single_counts * len(ff))
+    assert volume[2 + d2, -1 + d2, 0 + d2] > 0
+    # trilinear weights of each point sum to one
+    assert torch.isclose(counts.sum(), torch.tensor(float(len(ff))))
+
+
+def test_add_slice_empty_batch():
+    D = 9
+    volume = torch.zeros((D, D, D))
+    counts = torch.zeros((D, D, D))
+    add_slice(
+        volume,
+        counts,
+        torch.zeros(0, 5, 3),
+        torch.zeros(0, 5),
+        D,
+        torch.ones(0, 1),
+    )
+    assert not volume.any() and not counts.any()
+
+
+@pytest.fixture
+def toy_ctf_file(tmpdir):
+    """The CTF parameters of the first image in ctf1.pkl for every toy projection."""
+    ctf_params = pickle.load(open(f"{DATA_FOLDER}/ctf1.pkl", "rb"))
+    ctf_file = os.path.join(tmpdir, "toy_ctf.pkl")
+    with open(ctf_file, "wb") as f:
+        pickle.dump(np.repeat(ctf_params[:1], 1000, axis=0), f)
+    return ctf_file
+
+
+def backproject_toy(outdir, ctf_file, *args):
+    """Backproject the toy projections, returning the volumes found in `outdir`."""
+    parser = argparse.ArgumentParser()
+    backproject_voxel.add_args(parser)
+    backproject_voxel.main(
+        parser.parse_args(
+            [
+                f"{DATA_FOLDER}/toy_projections.mrcs",
+                "--poses",
+                f"{DATA_FOLDER}/toy_rot_trans.pkl",
+                "--ctf",
+                ctf_file,
+                "-o",
+                os.path.join(outdir, "vol.mrc"),
+                "--output-sumcount",
+                "--first",
+                "33",  # the last batch of 16 images has an empty second half
+                *args,
+            ]
+        )
+    )
+    return {
+        fl: MRCFile.parse(os.path.join(outdir, fl))[0]
+        for fl in os.listdir(outdir)
+        if ".mrc" in fl
+    }
+
+
+def test_backproject_batch_size(tmpdir, toy_ctf_file):
+    single = backproject_toy(os.path.join(tmpdir, "b1"), toy_ctf_file, "-b", "1")
+    batched = backproject_toy(os.path.join(tmpdir, "b16"), toy_ctf_file, "-b", "16")
+
+    assert "vol_half-map1.mrc" in single and "vol_half-map2.mrc" in single
+    for fl in single:
+        assert np.allclose(single[fl], batched[fl], atol=1e-4), fl
+
+
+def test_backproject_half_maps_sum(tmpdir, toy_ctf_file):
+    halves = backproject_toy(os.path.join(tmpdir, "halves"), toy_ctf_file, "-b", "16")
+    full = backproject_toy(
+        os.path.join(tmpdir, "full"), toy_ctf_file, "-b", "16", "--no-half-maps"
+    )
+
+    for fl in ("vol.mrc", "vol.mrc.sums", "vol.mrc.counts"):
+        assert np.allclose(halves[fl], full[fl], atol=1e-4), fl
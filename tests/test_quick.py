@@ -1,8 +1,10 @@
 import argparse
 import os.path
+import re
 import shutil
 
 import pytest
+import torch
 
 from cryodrgn.commands import (
     analyze,
@@ -157,3 +159,61 @@ def test_run(mrcs_file, poses_file):
         ]
     )
     eval_vol.main(args)
+
+
+def train_losses(outdir, mrcs_file, poses_file, *args):
+    """Train for two epochs, returning the total loss of each epoch."""
+    train_vae.main(
+        train_vae.add_args(argparse.ArgumentParser()).parse_args(
+            [
+                mrcs_file,
+                "-o",
+                outdir,
+                "--num-epochs",
+                "2",
+                "--checkpoint",
+                "1",
+                "--seed",
+                "0",
+                "--poses",
+                poses_file,
+                "--zdim",
+                "8",
+                *args,
+            ]
+        )
+    )
+    for epoch in range(2):
+        assert os.path.isfile(os.path.join(outdir, f"weights.{epoch}.pkl"))
+        assert os.path.isfile(os.path.join(outdir, f"z.{epoch}.pkl"))
+    assert os.path.isfile(os.path.join(outdir, "z.pkl"))
+
+    with open(os.path.join(outdir, "run.log")) as f:
+        return [
+            float(loss)
+            for loss in re.findall(
+                r"Average gen loss .* total loss = ([^;]+);", f.read()
+            )
+        ]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+@pytest.mark.parametrize(
+    "train_args",
+    [[], ["--do-pose-sgd", "--domain", "hartley"]],
+    ids=["default", "pose-sgd"],
+)
+def test_cuda_graphs(tmpdir, mrcs_file, poses_file, train_args):
+    eager_losses = train_losses(
+        os.path.join(tmpdir, "eager"), mrcs_file, poses_file, *train_args
+    )
+    graph_losses = train_losses(
+        os.path.join(tmpdir, "graphs"),
+        mrcs_file,
+        poses_file,
+        "--cuda-graphs",
+        *train_args,
+    )
+
+    assert len(graph_losses) == len(eager_losses) == 2
+    assert graph_losses == pytest.approx(eager_losses, rel=0.05)
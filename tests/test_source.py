@@ -197,3 +197,16 @@ def test_prespecified_indices_eager_chunked(mrcs_data):
             assert torch.allclose(mrcs_data[np.array([0, 1]), :, :], chunk)
         elif i == 1:
             assert torch.allclose(mrcs_data[np.array([5, 304]), :, :], chunk)
+
+
+def test_noncontiguous_indices(mrcs_data):
+    # Runs of consecutive indices are read together; check that gaps between runs,
+    # as well as unsorted indices, are handled correctly.
+    indices = np.array([3, 4, 5, 9, 10, 2, 40, 41, 42, 43, 0])
+    src = ImageSource.from_file(f"{DATA_FOLDER}/toy_projections.mrcs")
+    assert torch.allclose(src.images(indices), mrcs_data[indices])
+
+    src = ImageSource.from_file(
+        f"{DATA_FOLDER}/toy_projections.mrcs", indices=np.sort(indices)
+    )
+    assert torch.allclose(src.images(), mrcs_data[np.sort(indices)])